@@ -5,7 +5,7 @@ Adapted from https://github.com/openai/CLIP. Originally MIT License, Copyright (
 from dataclasses import dataclass
 import logging
 import math
-from typing import Optional, Tuple, Union
+from typing import Callable, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -16,7 +16,8 @@ from torch.utils.checkpoint import checkpoint
 from .hf_model import HFTextEncoder
 from .modified_resnet import ModifiedResNet
 from .timm_model import TimmModel
-from .transformer import LayerNormFp32, LayerNorm, QuickGELU, Attention, VisionTransformer, TextTransformer, SPAROVisionTransformer, SPAROTextTransformer, FDTQueryModel
+from .transformer import LayerNormFp32, LayerNorm, QuickGELU, Attention, VisionTransformer, TextTransformer, SPAROVisionTransformer, SPAROTextTransformer, FDTQueryModel, \
+    flex_attention
 from .utils import to_2tuple
 
 
@@ -87,6 +88,20 @@ def get_input_dtype(precision: str):
     return input_dtype
 
 
+def _l2_normalize_fp32(x: torch.Tensor, eps: float = 1e-12):
+    # single reduction + rsqrt on an explicit fp32 copy so low-precision embeddings keep accurate
+    # cosine similarities. autocast leaves these ops in fp32, no autocast context is needed
+    x32 = x.float()
+    return (x32 * torch.rsqrt(x32.pow(2).sum(dim=-1, keepdim=True).clamp_min(eps * eps))).to(x.dtype)
+
+
+def _image_memory_format(image: torch.Tensor, channels_last: bool):
+    if channels_last and image.dim() == 4:
+        # match the channels_last conv weights so cudnn can use its NHWC kernels without relayouts
+        return image.contiguous(memory_format=torch.channels_last)
+    return image
+
+
 def _build_vision_tower(
         embed_dim: int,
         vision_cfg: CLIPVisionCfg,
@@ -201,6 +216,7 @@ def _build_text_tower(
         reduce_depth: Optional[int] = 0,
         share_kv: bool = True,
         use_codebook: bool = False,
+        flex_attn: bool = False,
 ):
     if isinstance(text_cfg, dict):
         text_cfg = CLIPTextCfg(**text_cfg)
@@ -242,6 +258,7 @@ def _build_text_tower(
                 value_dim=sparo_value_dim,
                 sparo_heads=sparo_heads,
                 share_kv=share_kv,
+                flex_attn=flex_attn,
             )
         else:
             text = TextTransformer(
@@ -262,12 +279,14 @@ def _build_text_tower(
                 n_queries=text_cfg.n_queries,
                 attn_pooler_heads=text_cfg.attn_pooler_heads,
                 use_codebook=use_codebook,
+                flex_attn=flex_attn,
             )
     return text
 
 
 class CLIP(nn.Module):
     output_dict: torch.jit.Final[bool]
+    use_channels_last: torch.jit.Final[bool]
 
     def __init__(
             self,
@@ -290,6 +309,9 @@ class CLIP(nn.Module):
             use_codebook: bool = False,
             num_codes: int = 16384,
             bottleneck_dim: Optional[int] = None,
+            compile_ops: bool = False,  # torch.compile the text tower and small op chains, requires pytorch 2.2 or later
+            text_flex_attn: bool = False,  # causal text attention via FlexAttention, requires pytorch 2.5 or later
+            use_channels_last: bool = False,  # NHWC vision tower convs, pays off with cudnn on Ampere or later
     ):
         super().__init__()
         self.embed_dim = embed_dim
@@ -300,9 +322,14 @@ class CLIP(nn.Module):
         self.sparo_type = sparo_type
         self.use_codebook = use_codebook
         self.bottleneck_dim = bottleneck_dim
+        self.use_channels_last = use_channels_last
 
         if use_sparo and use_codebook:
             raise ValueError("SPARO and codebook cannot be used together yet.")
+        if text_flex_attn and flex_attention is None:
+            raise RuntimeError("text_flex_attn requires FlexAttention (pytorch 2.5 or later).")
+        if compile_ops and not hasattr(nn.Module, 'compile'):
+            raise RuntimeError("compile_ops requires Module.compile (pytorch 2.2 or later).")
 
         if not use_sparo or not sparo_type.endswith("softmax"):
             self.model_V = V
@@ -338,6 +365,7 @@ class CLIP(nn.Module):
             reduce_depth=reduce_depth,
             share_kv=share_kv,
             use_codebook=use_codebook,
+            flex_attn=text_flex_attn,
         )
         if self.use_sparo and share_queries:
             text.sparo.q_emb = self.visual.sparo.q_emb
@@ -346,19 +374,7 @@ class CLIP(nn.Module):
             self.vision_bottleproj = nn.Linear(bottleneck_dim, embed_dim)
             self.text_bottleproj = nn.Linear(bottleneck_dim, embed_dim)
 
-        self.transformer = text.transformer
-        self.context_length = text.context_length
-        self.vocab_size = text.vocab_size
-        self.token_embedding = text.token_embedding
-        self.positional_embedding = text.positional_embedding
-        if not use_codebook:
-            self.text_attn_pool = text.attn_pool
-            self.text_global_average_pool = text.global_average_pool
-            self.ln_final = text.ln_final
-            if not use_sparo:
-                self.text_projection = text.text_projection
-            else:
-                self.text_sparo = text.sparo
+        self.text = text
 
         if use_codebook:
             #learnable FDT
@@ -368,61 +384,155 @@ class CLIP(nn.Module):
             self.img_query_model = FDTQueryModel(self.visual.width, bottleneck_dim or embed_dim)
             self.txt_query_model = FDTQueryModel(text.width, bottleneck_dim or embed_dim)
 
-        self.register_buffer('attn_mask', text.attn_mask, persistent=False)
-
         self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
+        self._register_load_state_dict_pre_hook(_convert_legacy_text_state_dict_hook)
+
+        if use_channels_last:
+            self.visual.to(memory_format=torch.channels_last)
+
+        if compile_ops:
+            # compile the whole text tower as one graph, in place so state dict keys are unchanged.
+            # this covers the embedding prelude (token embedding, cast, positional add) together
+            # with the blocks, so the prelude no longer needs a compiled function of its own
+            self.text.compile(dynamic=False)
+
+        if use_sparo:
+            self._project_for_sparo = self._make_sparo_projector(*sparo_type.split(":"))
+            if compile_ops:
+                # the projector is straight-line for a given sparo_type, let inductor fuse its
+                # elementwise + reduction chain into a couple of kernels
+                self._project_for_sparo = torch.compile(self._project_for_sparo, dynamic=False, fullgraph=True)
+
+        # the encoder variant is fixed per model, pick it once instead of branching on every call.
+        # plain functions (not bound methods) so DataParallel replicas call them on themselves and
+        # the module holds no reference cycle. encode_image_full / encode_text_full keep the
+        # return_sparo / return_attn outputs
+        encode_mode = "sparo" if use_sparo else "codebook" if use_codebook else "dense"
+        self._encode_image_impl = getattr(type(self), f"_encode_image_{encode_mode}")
+        self._encode_text_impl = getattr(type(self), f"_encode_text_{encode_mode}")
+
+    @property
+    def context_length(self):
+        return self.text.context_length
+
+    @property
+    def vocab_size(self):
+        return self.text.vocab_size
 
     def lock_image_tower(self, unlocked_groups=0, freeze_bn_stats=False):
         # lock image tower as per LiT - https://arxiv.org/abs/2111.07991
         self.visual.lock(unlocked_groups=unlocked_groups, freeze_bn_stats=freeze_bn_stats)
 
     @torch.jit.ignore
-    def set_grad_checkpointing(self, enable=True):
-        self.visual.set_grad_checkpointing(enable)
-        self.transformer.grad_checkpointing = enable
+    def set_grad_checkpointing(self, enable=True, segments: Optional[int] = None):
+        # segments: number of checkpointed groups of transformer blocks per tower, None for one block per group
+        if isinstance(self.visual, VisionTransformer):
+            self.visual.set_grad_checkpointing(enable, segments=segments)
+        else:
+            self.visual.set_grad_checkpointing(enable)
+        self.text.set_grad_checkpointing(enable, segments=segments)
 
-    def _project_for_sparo(self, x):
-        x = x.view(*x.shape[:-1], self.L, self.model_V)
+    def _make_sparo_projector(self, rep_type: str, norm_type: str) -> Callable[[torch.Tensor], torch.Tensor]:
+        # sparo_type is fixed per model, so resolve it once here instead of on every encode.
+        # the returned projector takes the towers' (..., L, model_V) output as is
+        L = self.L
+
+        if rep_type == "cont":
+            def _rep(x):
+                return F.normalize(x, dim=-1)
+        elif rep_type == "sqrtsem":
+            def _rep(x):
+                return torch.sqrt(F.softmax(x, dim=-1))
+        elif rep_type == "sem":
+            def _rep(x):
+                return F.normalize(F.softmax(x, dim=-1), dim=-1)
+        else:
+            raise NotImplementedError
 
-        rep_type, norm_type = self.sparo_type.split(":")
         if norm_type == "sqrtsoftmax":
-            weights = torch.sqrt(F.softmax(x[..., :1], dim=-2))
-            x = x[..., 1:]
+            def _project(x):
+                weights = torch.sqrt(F.softmax(x[..., :1], dim=-2))
+                return _rep(x[..., 1:]) * weights
         elif norm_type == "softmax":
-            weights = F.normalize(F.softmax(x[..., :1], dim=-2), dim=-2)
-            x = x[..., 1:]
+            def _project(x):
+                weights = F.normalize(F.softmax(x[..., :1], dim=-2), dim=-2)
+                return _rep(x[..., 1:]) * weights
         elif norm_type == "norm":
             if rep_type == "cont":
-                norm_in = x
+                def _norm_in(x):
+                    return x
             elif rep_type == "sqrtsem":
-                norm_in = torch.exp(x / 2.0)
+                def _norm_in(x):
+                    return torch.exp(x / 2.0)
             else:
                 raise NotImplementedError
-            full_norm = torch.norm(norm_in.view(*norm_in.shape[:-2], -1), dim=-1, keepdim=True).unsqueeze(-1)
-            weights = torch.norm(norm_in, dim=-1, keepdim=True) / full_norm
+
+            def _project(x):
+                head_norm = torch.linalg.vector_norm(_norm_in(x), dim=-1, keepdim=True)
+                # norm over L*V is the norm of the per-head norms, so the second reduction only reads L values
+                full_norm = torch.linalg.vector_norm(head_norm, dim=-2, keepdim=True)
+                weights = head_norm / full_norm
+                return _rep(x) * weights
         elif norm_type == "const":
-            weights = torch.sqrt(torch.ones_like(x[..., :1]) / self.L)
-        else:
-            raise NotImplementedError
-        if rep_type == "cont":
-            out_rep = F.normalize(x, dim=-1)
-        elif rep_type == "sqrtsem":
-            out_rep = torch.sqrt(F.softmax(x, dim=-1))
-        elif rep_type == "sem":
-            out_rep = F.normalize(F.softmax(x, dim=-1), dim=-1)
+            const_weight = (1.0 / L) ** 0.5
+
+            def _project(x):
+                return _rep(x) * const_weight
         else:
             raise NotImplementedError
-        out = out_rep * weights
-        return out
+        return _project
 
-    def encode_image(self, image, normalize: bool = False, return_sparo: bool = False, return_attn=False):
-        features = self.visual(image)
+    def encode_image(self, image, normalize: bool = False):
+        return self._encode_image_impl(self, image, normalize)
+
+    def encode_text(self, text, normalize: bool = False):
+        return self._encode_text_impl(self, text, normalize)
+
+    def _encode_image_dense(self, image, normalize: bool = False):
+        features = self.visual(_image_memory_format(image, self.use_channels_last))
+        if self.bottleneck_dim is not None:
+            features = self.vision_bottleproj(features)
+        return _l2_normalize_fp32(features) if normalize else features
+
+    def _encode_image_codebook(self, image, normalize: bool = False):
+        features = self.img_query_model(
+            self.visual(_image_memory_format(image, self.use_channels_last)), self.space_dict)
+        if self.bottleneck_dim is not None:
+            features = self.vision_bottleproj(features)
+        return _l2_normalize_fp32(features) if normalize else features
+
+    def _encode_image_sparo(self, image, normalize: bool = True):
+        assert normalize
+        out, _ = self.visual(_image_memory_format(image, self.use_channels_last))
+        return self._project_for_sparo(out).flatten(-2)
+
+    def _encode_text_dense(self, text, normalize: bool = False):
+        # eot_token is the highest number in each sequence
+        x = self.text(text, text.argmax(dim=-1))
+        if self.bottleneck_dim is not None:
+            x = self.text_bottleproj(x)
+        return _l2_normalize_fp32(x) if normalize else x
+
+    def _encode_text_codebook(self, text, normalize: bool = False):
+        eos = text.argmax(dim=-1)
+        x = self.txt_query_model(self.text(text, eos), self.space_dict, eos_pos=eos)
+        if self.bottleneck_dim is not None:
+            x = self.text_bottleproj(x)
+        return _l2_normalize_fp32(x) if normalize else x
+
+    def _encode_text_sparo(self, text, normalize: bool = True):
+        assert normalize
+        out, _ = self.text(text, text.argmax(dim=-1))
+        return self._project_for_sparo(out).flatten(-2)
+
+    def encode_image_full(self, image, normalize: bool = False, return_sparo: bool = False, return_attn=False):
+        features = self.visual(_image_memory_format(image, self.use_channels_last))
         if not self.use_sparo:
             if self.use_codebook:
                 features = self.img_query_model(features, self.space_dict)
             if self.bottleneck_dim is not None:
                 features = self.vision_bottleproj(features)
-            return F.normalize(features, dim=-1) if normalize else features
+            return _l2_normalize_fp32(features) if normalize else features
         else:
             assert normalize
             out, attn = features
@@ -433,47 +543,23 @@ class CLIP(nn.Module):
                 else:
                     return out
             else:
-                image_features = out.view(*out.shape[:-2], -1)
+                image_features = out.flatten(-2)
                 return image_features
 
-    def encode_text(self, text, normalize: bool = False, return_sparo: bool = False, return_attn=False):
-        cast_dtype = self.transformer.get_cast_dtype()
-
-        x = self.token_embedding(text).to(cast_dtype)  # [batch_size, n_ctx, d_model]
-
-        x = x + self.positional_embedding.to(cast_dtype)
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x, attn_mask=self.attn_mask)
-        x = x.permute(1, 0, 2)  # LND -> NLD
-        if not self.use_codebook:
-            if self.text_attn_pool is not None:
-                x = self.text_attn_pool(x, text.argmax(dim=-1))
-            x = self.ln_final(x)  # [batch_size, n_ctx, transformer.width]
+    def encode_text_full(self, text, normalize: bool = False, return_sparo: bool = False, return_attn=False):
+        # eot_token is the highest number in each sequence
+        eos = text.argmax(dim=-1)
+        x = self.text(text, eos)
 
         if not self.use_sparo:
-            if not self.use_codebook:
-                if self.text_attn_pool is not None:
-                    if self.text_global_average_pool:
-                        x = x.mean(dim=1)
-                    else:
-                        x = x[:, 0]
-                else:
-                    if self.text_global_average_pool:
-                        raise NotImplementedError  # TODO
-                    else:
-                        # take features from the eot embedding (eot_token is the highest number in each sequence)
-                        x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)]
-                x = x @ self.text_projection
-            else:
-                x = self.txt_query_model(x, self.space_dict, eos_pos=text.argmax(dim=-1))
+            if self.use_codebook:
+                x = self.txt_query_model(x, self.space_dict, eos_pos=eos)
             if self.bottleneck_dim is not None:
                 x = self.text_bottleproj(x)
-            return F.normalize(x, dim=-1) if normalize else x
+            return _l2_normalize_fp32(x) if normalize else x
         else:
             assert normalize
-            # take features from the eot embedding (eot_token is the highest number in each sequence)
-            out, attn = self.text_sparo(x, text.argmax(dim=-1))
-            out = out.view(-1, self.L * self.model_V)
+            out, attn = x
             out = self._project_for_sparo(out)
             if return_sparo:
                 if return_attn:
@@ -481,7 +567,7 @@ class CLIP(nn.Module):
                 else:
                     return out
             else:
-                text_features = out.view(*out.shape[:-2], -1)
+                text_features = out.flatten(-2)
                 return text_features
 
     def forward(
@@ -491,17 +577,20 @@ class CLIP(nn.Module):
     ):
         image_features = self.encode_image(image, normalize=True) if image is not None else None
         text_features = self.encode_text(text, normalize=True) if text is not None else None
+        # same range the training loop clamps the parameter to, so this only guards externally set values
+        logit_scale = self.logit_scale.clamp(0, math.log(100)).exp()
         if self.output_dict:
             return {
                 "image_features": image_features,
                 "text_features": text_features,
-                "logit_scale": self.logit_scale.exp()
+                "logit_scale": logit_scale
             }
-        return image_features, text_features, self.logit_scale.exp()
+        return image_features, text_features, logit_scale
 
 
 class CustomTextCLIP(nn.Module):
     output_dict: torch.jit.Final[bool]
+    use_channels_last: torch.jit.Final[bool]
 
     def __init__(
             self,
@@ -511,10 +600,14 @@ class CustomTextCLIP(nn.Module):
             quick_gelu: bool = False,
             cast_dtype: Optional[torch.dtype] = None,
             output_dict: bool = False,
+            use_channels_last: bool = False,
     ):
         super().__init__()
         self.output_dict = output_dict
+        self.use_channels_last = use_channels_last
         self.visual = _build_vision_tower(embed_dim, vision_cfg, quick_gelu, cast_dtype)
+        if use_channels_last:
+            self.visual.to(memory_format=torch.channels_last)
         self.text = _build_text_tower(embed_dim, text_cfg, quick_gelu, cast_dtype)
         self.context_length = self.text.context_length
         self.vocab_size = self.text.vocab_size
@@ -533,12 +626,12 @@ class CustomTextCLIP(nn.Module):
         self.text.set_grad_checkpointing(enable)
 
     def encode_image(self, image, normalize: bool = False):
-        features = self.visual(image)
-        return F.normalize(features, dim=-1) if normalize else features
+        features = self.visual(_image_memory_format(image, self.use_channels_last))
+        return _l2_normalize_fp32(features) if normalize else features
 
     def encode_text(self, text, normalize: bool = False):
         features = self.text(text)
-        return F.normalize(features, dim=-1) if normalize else features
+        return _l2_normalize_fp32(features) if normalize else features
 
     def forward(
             self,
@@ -547,29 +640,25 @@ class CustomTextCLIP(nn.Module):
     ):
         image_features = self.encode_image(image, normalize=True) if image is not None else None
         text_features = self.encode_text(text, normalize=True) if text is not None else None
+        # same range the training loop clamps the parameter to, so this only guards externally set values
+        logit_scale = self.logit_scale.clamp(0, math.log(100)).exp()
         if self.output_dict:
             return {
                 "image_features": image_features,
                 "text_features": text_features,
-                "logit_scale": self.logit_scale.exp()
+                "logit_scale": logit_scale
             }
-        return image_features, text_features, self.logit_scale.exp()
+        return image_features, text_features, logit_scale
 
 
 def convert_weights_to_lp(model: nn.Module, dtype=torch.float16):
     """Convert applicable model parameters to low-precision (bf16 or fp16)"""
 
     def _convert_weights(l):
-        if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear)):
-            l.weight.data = l.weight.data.to(dtype)
-            if l.bias is not None:
-                l.bias.data = l.bias.data.to(dtype)
-
-        if isinstance(l, (nn.MultiheadAttention, Attention)):
-            for attr in [*[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]], "in_proj_bias", "bias_k", "bias_v"]:
-                tensor = getattr(l, attr)
-                if tensor is not None:
-                    tensor.data = tensor.data.to(dtype)
+        if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear, nn.MultiheadAttention, Attention)):
+            # Module.to converts every floating point tensor of the module in place via _apply,
+            # including the fused / optional MHA projections, and keeps Parameter identity
+            l.to(dtype)
 
         if isinstance(l, (CLIP, TextTransformer)):
             # convert text nn.Parameter projections
@@ -577,6 +666,15 @@ def convert_weights_to_lp(model: nn.Module, dtype=torch.float16):
             if attr is not None:
                 attr.data = attr.data.to(dtype)
 
+        if isinstance(l, CLIP):
+            # FDT codebook, matmul'd against the (already converted) query projections
+            attr = getattr(l, "space_dict", None)
+            if attr is not None:
+                attr.data = attr.data.to(dtype)
+
+        if isinstance(l, TextTransformer):
+            l._pos_embed_cache.clear()
+
         if isinstance(l, VisionTransformer):
             # convert vision nn.Parameter projections
             attr = getattr(l, "proj", None)
@@ -591,7 +689,7 @@ convert_weights_to_fp16 = convert_weights_to_lp  # backwards compat
 
 # used to maintain checkpoint compatibility
 def convert_to_custom_text_state_dict(state_dict: dict):
-    if 'text_projection' in state_dict:
+    if 'positional_embedding' in state_dict:
         # old format state_dict, move text tower -> .text
         new_state_dict = {}
         for k, v in state_dict.items():
@@ -603,11 +701,24 @@ def convert_to_custom_text_state_dict(state_dict: dict):
                 'ln_final',
             )):
                 k = 'text.' + k
+            elif k.startswith(('text_sparo.', 'text_attn_pool.')):
+                # text tower heads that used to be aliased onto CLIP as text_<name>
+                k = 'text.' + k[len('text_'):]
             new_state_dict[k] = v
         return new_state_dict
     return state_dict
 
 
+def _convert_legacy_text_state_dict_hook(state_dict, prefix, *args):
+    # load_state_dict pre-hook, lets raw load_state_dict calls (training resume, notebooks) take
+    # checkpoints saved before the CLIP text tower moved under .text
+    if prefix + 'positional_embedding' not in state_dict:
+        return
+    local_state_dict = {k[len(prefix):]: state_dict.pop(k) for k in list(state_dict) if k.startswith(prefix)}
+    for k, v in convert_to_custom_text_state_dict(local_state_dict).items():
+        state_dict[prefix + k] = v
+
+
 def build_model_from_openai_state_dict(
         state_dict: dict,
         quick_gelu=True,
@@ -615,17 +726,28 @@ def build_model_from_openai_state_dict(
 ):
     vit = "visual.proj" in state_dict
 
+    # count transformer blocks / resnet blocks in a single pass over the keys
+    vision_attn_count = 0
+    rn_block_ids = {f"layer{b}": set() for b in [1, 2, 3, 4]}
+    text_block_ids = set()
+    for k in state_dict:
+        parts = k.split(".")
+        if parts[0] == "visual":
+            if k.endswith(".attn.in_proj_weight"):
+                vision_attn_count += 1
+            elif parts[1] in rn_block_ids:
+                rn_block_ids[parts[1]].add(parts[2])
+        elif parts[0] == "transformer" and parts[1] == "resblocks":
+            text_block_ids.add(parts[2])
+
     if vit:
         vision_width = state_dict["visual.conv1.weight"].shape[0]
-        vision_layers = len(
-            [k for k in state_dict.keys() if k.startswith("visual.") and k.endswith(".attn.in_proj_weight")])
+        vision_layers = vision_attn_count
         vision_patch_size = state_dict["visual.conv1.weight"].shape[-1]
         grid_size = round((state_dict["visual.positional_embedding"].shape[0] - 1) ** 0.5)
         image_size = vision_patch_size * grid_size
     else:
-        counts: list = [
-            len(set(k.split(".")[2] for k in state_dict if k.startswith(f"visual.layer{b}"))) for b in [1, 2, 3, 4]]
-        vision_layers = tuple(counts)
+        vision_layers = tuple(len(ids) for ids in rn_block_ids.values())
         vision_width = state_dict["visual.layer1.0.conv1.weight"].shape[0]
         output_width = round((state_dict["visual.attnpool.positional_embedding"].shape[0] - 1) ** 0.5)
         vision_patch_size = None
@@ -637,7 +759,7 @@ def build_model_from_openai_state_dict(
     vocab_size = state_dict["token_embedding.weight"].shape[0]
     transformer_width = state_dict["ln_final.weight"].shape[0]
     transformer_heads = transformer_width // 64
-    transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
+    transformer_layers = len(text_block_ids)
 
     vision_cfg = CLIPVisionCfg(
         layers=vision_layers,
@@ -664,7 +786,7 @@ def build_model_from_openai_state_dict(
         state_dict.pop(key, None)
 
     convert_weights_to_fp16(model)  # OpenAI state dicts are partially converted to float16
-    model.load_state_dict(state_dict)
+    model.load_state_dict(convert_to_custom_text_state_dict(state_dict))
     return model.eval()
 
 
@@ -695,10 +817,9 @@ def resize_pos_embed(state_dict, model, interpolation: str = 'bicubic', antialia
     if new_seq_len == old_pos_embed.shape[0]:
         return
 
-    if extra_tokens:
-        pos_emb_tok, pos_emb_img = old_pos_embed[:extra_tokens], old_pos_embed[extra_tokens:]
-    else:
-        pos_emb_tok, pos_emb_img = None, old_pos_embed
+    # interpolate in fp32, the resampling kernels are fastest and most accurate there for fp16 / bf16 checkpoints
+    orig_dtype = old_pos_embed.dtype
+    pos_emb_tok, pos_emb_img = old_pos_embed.float().tensor_split([extra_tokens])
     old_grid_size = to_2tuple(int(math.sqrt(len(pos_emb_img))))
 
     logging.info('Resizing position embedding grid-size from %s to %s', old_grid_size, grid_size)
@@ -710,9 +831,7 @@ def resize_pos_embed(state_dict, model, interpolation: str = 'bicubic', antialia
         antialias=antialias,
         align_corners=False,
     )
-    pos_emb_img = pos_emb_img.permute(0, 2, 3, 1).reshape(1, grid_size[0] * grid_size[1], -1)[0]
-    if pos_emb_tok is not None:
-        new_pos_embed = torch.cat([pos_emb_tok, pos_emb_img], dim=0)
-    else:
-        new_pos_embed = pos_emb_img
-    state_dict['visual.positional_embedding'] = new_pos_embed
+    # [1, D, H, W] -> [H * W, D]
+    pos_emb_img = pos_emb_img.squeeze(0).flatten(1).t()
+    new_pos_embed = torch.cat([pos_emb_tok, pos_emb_img], dim=0) if extra_tokens else pos_emb_img
+    state_dict['visual.positional_embedding'] = new_pos_embed.to(orig_dtype)
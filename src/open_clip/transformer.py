@@ -1,14 +1,47 @@
 from collections import OrderedDict
+import inspect
 import math
-from typing import Callable, Optional, Sequence, Tuple
+from typing import Any, Callable, Optional, Sequence, Tuple
 
 import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.utils.checkpoint import checkpoint
 
+try:
+    # FlexAttention, pytorch >= 2.5
+    from torch.nn.attention.flex_attention import create_block_mask, flex_attention
+except ImportError:
+    create_block_mask = flex_attention = None
+
 from .utils import to_2tuple
 
+# resolved once at import, a module level bool is a constant to TorchScript so the unused branch is never compiled
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')  # pytorch >= 2.0
+
+# non-reentrant checkpointing (pytorch >= 1.11) supports keyword args and inputs that don't require grad
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+_compiled_flex_attention = None
+
+
+def _causal_mask_mod(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def build_causal_block_mask(seq_len: int, device: torch.device):
+    """Block-sparse causal mask for FlexAttention, fully masked blocks are skipped entirely."""
+    assert create_block_mask is not None, 'FlexAttention requires pytorch 2.5 or later'
+    return create_block_mask(_causal_mask_mod, B=None, H=None, Q_LEN=seq_len, KV_LEN=seq_len, device=device)
+
+
+def compiled_flex_attention(q, k, v, block_mask):
+    # flex_attention only generates a fused kernel under torch.compile, eager mode is a slow reference path
+    global _compiled_flex_attention
+    if _compiled_flex_attention is None:
+        _compiled_flex_attention = torch.compile(flex_attention, dynamic=False)
+    return _compiled_flex_attention(q, k, v, block_mask=block_mask)
+
 
 class LayerNormFp32(nn.LayerNorm):
     """Subclass torch's LayerNorm to handle fp16 (by casting to float32 and back)."""
@@ -255,11 +288,13 @@ class ResidualAttentionBlock(nn.Module):
             act_layer: Callable = nn.GELU,
             norm_layer: Callable = LayerNorm,
             is_cross_attention: bool = False,
+            batch_first: bool = False,
     ):
         super().__init__()
 
+        self.batch_first = batch_first
         self.ln_1 = norm_layer(d_model)
-        self.attn = nn.MultiheadAttention(d_model, n_head)
+        self.attn = nn.MultiheadAttention(d_model, n_head, batch_first=batch_first)
         self.ls_1 = LayerScale(d_model, ls_init_value) if ls_init_value is not None else nn.Identity()
         if is_cross_attention:
             self.ln_1_kv = norm_layer(d_model)
@@ -279,26 +314,79 @@ class ResidualAttentionBlock(nn.Module):
             k_x: Optional[torch.Tensor] = None,
             v_x: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
+            block_mask: Any = None,  # Optional[BlockMask], Any so TorchScript does not assume Tensor
+            is_causal: bool = False,
     ):
+        if block_mask is not None:
+            return self.flex_attention(q_x, block_mask)
+        if is_causal and attn_mask is None and k_x is None and v_x is None:
+            return self.causal_attention(q_x)
+
         k_x = k_x if k_x is not None else q_x
         v_x = v_x if v_x is not None else q_x
 
-        attn_mask = attn_mask.to(q_x.dtype) if attn_mask is not None else None
+        if attn_mask is not None and attn_mask.is_floating_point():
+            attn_mask = attn_mask.to(q_x.dtype)
         return self.attn(
             q_x, k_x, v_x, need_weights=False, attn_mask=attn_mask
         )[0]
 
+    def _in_projection(self, x: torch.Tensor):
+        # self-attention q, k, v from the nn.MultiheadAttention weights, LND (NLD if batch_first) -> N, nh, L, hd
+        num_heads = self.attn.num_heads
+        q, k, v = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias).chunk(3, dim=-1)
+        if self.batch_first:
+            N, L, C = x.shape
+            q = q.reshape(N, L, num_heads, -1).transpose(1, 2)
+            k = k.reshape(N, L, num_heads, -1).transpose(1, 2)
+            v = v.reshape(N, L, num_heads, -1).transpose(1, 2)
+        else:
+            L, N, C = x.shape
+            q = q.reshape(L, N, num_heads, -1).permute(1, 2, 0, 3)
+            k = k.reshape(L, N, num_heads, -1).permute(1, 2, 0, 3)
+            v = v.reshape(L, N, num_heads, -1).permute(1, 2, 0, 3)
+        return q, k, v
+
+    def _out_projection(self, x: torch.Tensor):
+        # N, nh, L, hd -> LND (NLD if batch_first)
+        N, _, L, _ = x.shape
+        if self.batch_first:
+            x = x.transpose(1, 2).reshape(N, L, -1)
+        else:
+            x = x.permute(2, 0, 1, 3).reshape(L, N, -1)
+        return self.attn.out_proj(x)
+
+    @torch.jit.ignore
+    def flex_attention(self, x: torch.Tensor, block_mask: Any) -> torch.Tensor:
+        # BlockMask and the lazily compiled kernel are python only, keep them out of scripted graphs
+        q, k, v = self._in_projection(x)
+        return self._out_projection(compiled_flex_attention(q, k, v, block_mask))
+
+    def causal_attention(self, x: torch.Tensor):
+        if not _HAS_SDPA:
+            # pytorch < 2.0, fall back to an explicit additive causal mask
+            L = x.shape[1] if self.batch_first else x.shape[0]
+            attn_mask = torch.full((L, L), float("-inf"), dtype=x.dtype, device=x.device).triu_(1)
+            return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
+        # is_causal without a mask tensor lets SDPA pick the flash / memory efficient kernels
+        q, k, v = self._in_projection(x)
+        dropout_p = self.attn.dropout if self.training else 0.
+        return self._out_projection(F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True))
+
     def forward(
             self,
             q_x: torch.Tensor,
             k_x: Optional[torch.Tensor] = None,
             v_x: Optional[torch.Tensor] = None,
             attn_mask: Optional[torch.Tensor] = None,
+            block_mask: Any = None,
+            is_causal: bool = False,
     ):
         k_x = self.ln_1_kv(k_x) if hasattr(self, "ln_1_kv") and k_x is not None else None
         v_x = self.ln_1_kv(v_x) if hasattr(self, "ln_1_kv") and v_x is not None else None
 
-        x = q_x + self.ls_1(self.attention(q_x=self.ln_1(q_x), k_x=k_x, v_x=v_x, attn_mask=attn_mask))
+        x = q_x + self.ls_1(self.attention(
+            q_x=self.ln_1(q_x), k_x=k_x, v_x=v_x, attn_mask=attn_mask, block_mask=block_mask, is_causal=is_causal))
         x = x + self.ls_2(self.mlp(self.ln_2(x)))
         return x
 
@@ -354,30 +442,74 @@ class Transformer(nn.Module):
             ls_init_value: float = None,
             act_layer: Callable = nn.GELU,
             norm_layer: Callable = LayerNorm,
+            batch_first: bool = False,
     ):
         super().__init__()
         self.width = width
         self.layers = layers
+        self.batch_first = batch_first
         self.grad_checkpointing = False
+        self.grad_checkpointing_segments = None  # number of checkpointed groups of blocks, None for one block per group
 
         self.resblocks = nn.ModuleList([
             ResidualAttentionBlock(
-                width, heads, mlp_ratio, ls_init_value=ls_init_value, act_layer=act_layer, norm_layer=norm_layer)
+                width, heads, mlp_ratio, ls_init_value=ls_init_value, act_layer=act_layer, norm_layer=norm_layer,
+                batch_first=batch_first)
             for _ in range(layers)
         ])
 
     def get_cast_dtype(self) -> torch.dtype:
+        # two attribute reads on the first block, cheap enough to resolve on every forward
         if hasattr(self.resblocks[0].mlp.c_fc, 'int8_original_dtype'):
             return self.resblocks[0].mlp.c_fc.int8_original_dtype
         return self.resblocks[0].mlp.c_fc.weight.dtype
 
-    def forward(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
+    @torch.jit.ignore
+    def _forward_blocks(
+            self,
+            x: torch.Tensor,
+            start: int,
+            end: int,
+            attn_mask: Optional[torch.Tensor] = None,
+            block_mask: Any = None,
+            is_causal: bool = False,
+    ):
+        for r in self.resblocks[start:end]:
+            x = r(x, attn_mask=attn_mask, block_mask=block_mask, is_causal=is_causal)
+        return x
+
+    @torch.jit.ignore
+    def _forward_checkpointed(
+            self,
+            x: torch.Tensor,
+            attn_mask: Optional[torch.Tensor] = None,
+            block_mask: Any = None,
+            is_causal: bool = False,
+    ):
+        # checkpoint groups of consecutive blocks, one block per group by default. fewer, larger groups store
+        # fewer boundary activations, but a whole group's activations are alive at once while it is recomputed
+        # in backward, so peak memory only drops when the boundaries dominate (https://arxiv.org/abs/1604.06174).
+        # compute is one extra forward either way
+        num_blocks = len(self.resblocks)
+        num_segments = self.grad_checkpointing_segments or num_blocks
+        segment_size = math.ceil(num_blocks / num_segments)
+        for start in range(0, num_blocks, segment_size):
+            x = checkpoint(
+                self._forward_blocks, x, start, start + segment_size, attn_mask, block_mask, is_causal,
+                **_CHECKPOINT_KWARGS)
+        return x
+
+    def forward(
+            self,
+            x: torch.Tensor,
+            attn_mask: Optional[torch.Tensor] = None,
+            block_mask: Any = None,
+            is_causal: bool = False,
+    ):
+        if self.grad_checkpointing and not torch.jit.is_scripting():
+            return self._forward_checkpointed(x, attn_mask, block_mask, is_causal)
         for r in self.resblocks:
-            if self.grad_checkpointing and not torch.jit.is_scripting():
-                # TODO: handle kwargs https://github.com/pytorch/pytorch/issues/79887#issuecomment-1161758372
-                x = checkpoint(r, x, None, None, attn_mask)
-            else:
-                x = r(x, attn_mask=attn_mask)
+            x = r(x, attn_mask=attn_mask, block_mask=block_mask, is_causal=is_causal)
         return x
 
 
@@ -521,8 +653,11 @@ class VisionTransformer(nn.Module):
         pass
 
     @torch.jit.ignore
-    def set_grad_checkpointing(self, enable=True):
+    def set_grad_checkpointing(self, enable=True, segments: Optional[int] = None):
+        if segments is not None and segments < 1:
+            raise ValueError(f"Grad checkpointing segments must be >= 1, got {segments}.")
         self.transformer.grad_checkpointing = enable
+        self.transformer.grad_checkpointing_segments = segments
 
     def _global_pool(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.global_average_pool:
@@ -621,12 +756,36 @@ class SPAROVisionTransformer(VisionTransformer):
     def forward_output(self, x: torch.Tensor):
         x = self.ln_post(x)  # B, L, H
         out, attn = self.sparo(x)  # B, L, V
-        out = out.view(-1, self.L * self.V)
         return out, attn
 
 
+class TextMeanPooler(nn.Module):
+    """Mean pooling over all tokens"""
+
+    def forward(self, x: torch.Tensor, eos: torch.Tensor):
+        return x.mean(dim=1)
+
+
+class TextFirstTokenPooler(nn.Module):
+    """First token pooling (first attentional pooler query)"""
+
+    def forward(self, x: torch.Tensor, eos: torch.Tensor):
+        return x[:, 0]
+
+
+class TextEosPooler(nn.Module):
+    """EOT token pooling"""
+
+    def forward(self, x: torch.Tensor, eos: torch.Tensor):
+        # take features from the eot embedding
+        return x.gather(1, eos.view(-1, 1, 1).expand(-1, 1, x.shape[-1])).squeeze(1)
+
+
 class TextTransformer(nn.Module):
     output_tokens: torch.jit.Final[bool]
+    flex_attn: torch.jit.Final[bool]
+    global_average_pool: torch.jit.Final[bool]
+    _has_attn_pool: torch.jit.Final[bool]
 
     def __init__(
             self,
@@ -648,9 +807,11 @@ class TextTransformer(nn.Module):
             attn_pooler_heads: int = 8,
             projection_in_dim: Optional[int] = None,
             use_codebook=False,
+            flex_attn: bool = False,
     ):
         super().__init__()
         self.output_tokens = output_tokens
+        self.flex_attn = flex_attn
         self.num_pos = self.context_length = context_length
         self.vocab_size = vocab_size
         self.width = width
@@ -678,20 +839,38 @@ class TextTransformer(nn.Module):
             ls_init_value=ls_init_value,
             act_layer=act_layer,
             norm_layer=norm_layer,
+            batch_first=True,
         )
 
         self.global_average_pool = global_average_pool
 
-        self.register_buffer('attn_mask', self.build_attention_mask(), persistent=False)
+        if flex_attn:
+            assert not embed_cls, 'FlexAttention text path does not support the CLS padding mask'
+            # the dense causal mask is replaced by block masks built per (seq_len, device) on first use
+            self.register_buffer('attn_mask', None, persistent=False)
+            self._causal_block_masks = {}
+        else:
+            self.register_buffer('attn_mask', self.build_attention_mask(), persistent=False)
+        # positional_embedding cast to the tower dtype, see _cast_positional_embedding
+        self._pos_embed_cache = {}
 
+        self._has_attn_pool = False
         if not use_codebook:
             if attentional_pool:
                 self.attn_pool = AttentionalPooler(output_dim, width, n_head=attn_pooler_heads, n_queries=n_queries)
                 self.ln_final = norm_layer(output_dim)
                 projection_in_dim = output_dim
+                self._has_attn_pool = True
             else:
                 self.attn_pool = None
                 self.ln_final = norm_layer(width)
+            # pooling is fixed by the config, pick it once instead of branching on every forward.
+            # global average pooling applies to the attentional pooler outputs, without a pooler
+            # the eot token is used as before
+            if self._has_attn_pool:
+                self.pooler = TextMeanPooler() if global_average_pool else TextFirstTokenPooler()
+            else:
+                self.pooler = TextEosPooler()
             self.text_projection = nn.Parameter(torch.empty(projection_in_dim, output_dim))
 
         self.create_extra_modules()
@@ -719,16 +898,45 @@ class TextTransformer(nn.Module):
             nn.init.normal_(self.text_projection, std=self.projection_in_dim ** -0.5)
 
     @torch.jit.ignore
-    def set_grad_checkpointing(self, enable=True):
+    def set_grad_checkpointing(self, enable=True, segments: Optional[int] = None):
+        if segments is not None and segments < 1:
+            raise ValueError(f"Grad checkpointing segments must be >= 1, got {segments}.")
         self.transformer.grad_checkpointing = enable
+        self.transformer.grad_checkpointing_segments = segments
+
+    def _apply(self, fn, *args, **kwargs):
+        # cached casts are stale once parameters are moved or converted
+        self._pos_embed_cache.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    @torch.jit.ignore
+    def _cast_positional_embedding(self, cast_dtype: torch.dtype) -> torch.Tensor:
+        pos_embed = self.positional_embedding
+        if pos_embed.dtype == cast_dtype or (torch.is_grad_enabled() and pos_embed.requires_grad):
+            # either no copy is needed or the cast has to be part of the autograd graph
+            return pos_embed.to(cast_dtype)
+        # keyed per device since DataParallel replicas share this dict. entries are checked against the
+        # source storage and version counter, so in-place updates (optimizer steps, load_state_dict)
+        # and replaced parameters invalidate them
+        key = (cast_dtype, pos_embed.device)
+        source = (pos_embed.data_ptr(), pos_embed._version)
+        cached_source, pos_embed_lp = self._pos_embed_cache.get(key, (None, None))
+        if cached_source != source:
+            pos_embed_lp = pos_embed.detach().to(cast_dtype)
+            self._pos_embed_cache[key] = (source, pos_embed_lp)
+        return pos_embed_lp
+
+    @torch.jit.ignore
+    def _get_causal_block_mask(self, seq_len: int, device: torch.device):
+        key = (seq_len, device)
+        if key not in self._causal_block_masks:
+            self._causal_block_masks[key] = build_causal_block_mask(seq_len, device)
+        return self._causal_block_masks[key]
 
     def build_attention_mask(self):
         # lazily create causal attention mask, with full attention between the tokens
-        # pytorch uses additive attention mask; fill with -inf
-        mask = torch.empty(self.num_pos, self.num_pos)
-        mask.fill_(float("-inf"))
-        mask.triu_(1)  # zero out the lower diagonal
-        return mask
+        # boolean, True where attention is not allowed (above the diagonal)
+        return torch.ones(self.num_pos, self.num_pos, dtype=torch.bool).triu_(1)
 
     def build_cls_mask(self, text, cast_dtype: torch.dtype):
         cls_mask = (text != self.pad_id).unsqueeze(1)
@@ -742,37 +950,49 @@ class TextTransformer(nn.Module):
     def _repeat(self, t, N: int):
         return t.reshape(1, 1, -1).repeat(N, 1, 1)
 
-    def forward(self, text):
+    def forward(self, text, eos: Optional[torch.Tensor] = None):
         cast_dtype = self.transformer.get_cast_dtype()
         seq_len = text.shape[1]
+        if eos is None:
+            # eot_token is the highest number in each sequence
+            eos = text.argmax(dim=-1)
 
         x = self.token_embedding(text).to(cast_dtype)  # [batch_size, n_ctx, d_model]
-        attn_mask = self.attn_mask
+        attn_mask = None
         if self.cls_emb is not None:
             seq_len += 1
             x = torch.cat([x, self._repeat(self.cls_emb, x.shape[0])], dim=1)
             cls_mask = self.build_cls_mask(text, cast_dtype)
-            attn_mask = attn_mask[None, :seq_len, :seq_len] + cls_mask[:, :seq_len, :seq_len]
-
-        x = x + self.positional_embedding[:seq_len].to(cast_dtype)
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x, attn_mask=attn_mask)
-        x = x.permute(1, 0, 2)  # LND -> NLD
+            # the CLS padding mask is per sample, so the causal mask has to be materialized (additive) here
+            causal_mask = torch.zeros(seq_len, seq_len, dtype=cast_dtype, device=x.device)
+            causal_mask.masked_fill_(self.attn_mask[:seq_len, :seq_len], float("-inf"))
+            attn_mask = causal_mask[None] + cls_mask[:, :seq_len, :seq_len]
+
+        x = x + self._cast_positional_embedding(cast_dtype)[:seq_len]
+        # the text transformer runs batch first, so x stays NLD throughout
+        if self.flex_attn:
+            x = self.transformer(x, block_mask=self._get_causal_block_mask(seq_len, x.device))
+        elif attn_mask is None:
+            x = self.transformer(x, is_causal=True)
+        else:
+            x = self.transformer(x, attn_mask=attn_mask)
 
-        return self.forward_output(x, text)
+        return self.forward_output(x, eos)
 
-    def forward_output(self, x: torch.Tensor, text: torch.Tensor):  # not used directly
+    def forward_output(self, x: torch.Tensor, eos: torch.Tensor):  # not used directly
         if self.use_codebook:
             return x
 
         # x.shape = [batch_size, n_ctx, transformer.width]
-        # take features from the eot embedding (eot_token is the highest number in each sequence)
         if self.cls_emb is not None:
             pooled, tokens = x[:, -1], x[:, :-1]
             pooled = self.ln_final(pooled)
         else:
+            if self._has_attn_pool:
+                x = self.attn_pool(x, eos)
             x = self.ln_final(x)
-            pooled, tokens = x[torch.arange(x.shape[0]), text.argmax(dim=-1)], x
+            pooled = self.pooler(x, eos)
+            tokens = x
 
         if self.text_projection is not None:
             pooled = pooled @ self.text_projection
@@ -820,11 +1040,11 @@ class SPAROTextTransformer(TextTransformer):
         )
         del self.text_projection
 
-    def forward_output(self, x: torch.Tensor, text: torch.Tensor):  # not used directly
+    def forward_output(self, x: torch.Tensor, eos: torch.Tensor):  # not used directly
+        if self._has_attn_pool:
+            x = self.attn_pool(x, eos)
         x = self.ln_final(x)  # B, L, H
-        # take features from the eot embedding (eot_token is the highest number in each sequence)
-        out, attn = self.sparo(x, text.argmax(dim=-1))  # B, L, V
-        out = out.view(-1, self.L * self.V)
+        out, attn = self.sparo(x, eos)  # B, L, V
         return out, attn
 
 
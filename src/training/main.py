@@ -340,6 +340,12 @@ def main(args):
             sd = checkpoint["state_dict"]
             if not args.distributed and next(iter(sd.items()))[0].startswith('module'):
                 sd = {k[len('module.'):]: v for k, v in sd.items()}
+            if optimizer is not None and any(k in ('positional_embedding', 'module.positional_embedding') for k in sd):
+                # the model weights are remapped on load, but optimizer state is matched to parameters by position
+                # and the text tower parameters were reordered when they moved under .text
+                raise RuntimeError(
+                    f"Checkpoint '{args.resume}' predates the CLIP text tower layout change, its optimizer state "
+                    "cannot be resumed. Save checkpoint['state_dict'] on its own and pass that to --resume instead.")
             model.load_state_dict(sd)
             if optimizer is not None:
                 optimizer.load_state_dict(checkpoint["optimizer"])
@@ -0,0 +1,47 @@
+import pytest
+import torch
+from open_clip.transformer import ResidualAttentionBlock, TextTransformer
+
+
+def _dense_causal_mask(seq_len):
+    return torch.full((seq_len, seq_len), float("-inf")).triu_(1)
+
+
+@pytest.mark.parametrize("batch_first", [False, True])
+def test_causal_attention_matches_dense_mask(batch_first):
+    torch.manual_seed(0)
+    width, heads, batch, seq_len = 64, 4, 3, 7
+    block = ResidualAttentionBlock(width, heads, batch_first=batch_first).eval()
+    x = torch.randn(batch, seq_len, width) if batch_first else torch.randn(seq_len, batch, width)
+    with torch.no_grad():
+        expected = block(x, attn_mask=_dense_causal_mask(seq_len))
+        actual = block(x, is_causal=True)
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+def test_text_tower_cls_mask_matches_causal_path():
+    # the CLS token is appended last and only its own query row is padding masked,
+    # so every other token must come out exactly as in the plain is_causal path
+    torch.manual_seed(0)
+    context_length, vocab_size = 12, 100
+    tower = TextTransformer(
+        context_length=context_length,
+        vocab_size=vocab_size,
+        width=64,
+        heads=4,
+        layers=2,
+        output_dim=32,
+        embed_cls=True,
+        output_tokens=True,
+    ).eval()
+    text = torch.randint(1, vocab_size - 1, (3, context_length))
+    text[0, 5:] = 0  # padded sample
+    text[:, -1] = vocab_size - 1
+    with torch.no_grad():
+        pooled, tokens = tower(text)
+        x = tower.token_embedding(text) + tower.positional_embedding[:context_length]
+        expected = tower.transformer(x, is_causal=True)
+    assert pooled.shape == (3, 32)
+    assert torch.isfinite(pooled).all()
+    assert torch.allclose(tokens, expected, atol=1e-5)
@@ -0,0 +1,32 @@
+import pytest
+import torch
+from open_clip.transformer import TextTransformer, Transformer
+
+
+@pytest.mark.parametrize("segments", [None, 1, 2, 3])
+def test_grad_checkpointing_matches_plain(segments):
+    torch.manual_seed(0)
+    model = Transformer(width=32, layers=4, heads=4)
+    x = torch.randn(5, 2, 32)
+
+    def _run(grad_checkpointing):
+        model.zero_grad()
+        model.grad_checkpointing = grad_checkpointing
+        model.grad_checkpointing_segments = segments
+        inp = x.clone().requires_grad_()
+        out = model(inp)
+        out.square().sum().backward()
+        return out.detach(), inp.grad, [p.grad.clone() for p in model.parameters()]
+
+    out_ref, inp_grad_ref, grads_ref = _run(False)
+    out, inp_grad, grads = _run(True)
+    assert torch.allclose(out, out_ref)
+    assert torch.allclose(inp_grad, inp_grad_ref, atol=1e-6)
+    for g, g_ref in zip(grads, grads_ref):
+        assert torch.allclose(g, g_ref, atol=1e-6)
+
+
+def test_grad_checkpointing_rejects_bad_segments():
+    tower = TextTransformer(context_length=8, vocab_size=50, width=32, heads=4, layers=2, output_dim=16)
+    with pytest.raises(ValueError):
+        tower.set_grad_checkpointing(True, segments=0)
@@ -0,0 +1,18 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from open_clip.model import _l2_normalize_fp32
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_l2_normalize_fp32_matches_f_normalize(dtype):
+    torch.manual_seed(0)
+    x = torch.randn(4, 3, 16)
+    x[1, 2] = 0  # zero vectors stay zero, as with F.normalize
+    x = x.to(dtype)
+    actual = _l2_normalize_fp32(x)
+    expected = F.normalize(x.float(), dim=-1).to(dtype)
+    assert actual.dtype == dtype
+    assert torch.equal(actual[1, 2], torch.zeros_like(actual[1, 2]))
+    atol = 1e-6 if dtype == torch.float32 else 1e-2
+    assert torch.allclose(actual.float(), expected.float(), atol=atol)
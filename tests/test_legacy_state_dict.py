@@ -0,0 +1,47 @@
+import pytest
+import torch
+from open_clip.model import CLIP
+
+VISION_CFG = dict(layers=2, width=64, head_width=32, patch_size=16, image_size=32)
+TEXT_CFG = dict(context_length=16, vocab_size=100, width=64, heads=4, layers=2)
+SPARO_TEXT_CFG = dict(TEXT_CFG, attentional_pool=True, n_queries=4, attn_pooler_heads=4)
+
+
+def _to_legacy(state_dict):
+    # layout CLIP saved before the text tower moved under .text, text heads were aliased as text_<name>
+    legacy = {}
+    for k, v in state_dict.items():
+        if k.startswith(('text.sparo.', 'text.attn_pool.')):
+            k = 'text_' + k[len('text.'):]
+        elif k.startswith('text.'):
+            k = k[len('text.'):]
+        legacy[k] = v
+    return legacy
+
+
+@pytest.mark.parametrize("text_cfg,model_kwargs", [
+    (TEXT_CFG, dict()),
+    (SPARO_TEXT_CFG, dict(use_sparo=True, L=4, V=8, sparo_heads=2)),
+])
+def test_load_legacy_text_state_dict(text_cfg, model_kwargs):
+    torch.manual_seed(0)
+    src = CLIP(64, VISION_CFG, text_cfg, **model_kwargs)
+    expected = src.state_dict()
+    legacy = _to_legacy(expected)
+    assert 'positional_embedding' in legacy
+    if model_kwargs.get('use_sparo'):
+        assert any(k.startswith('text_sparo.') for k in legacy)
+        assert any(k.startswith('text_attn_pool.') for k in legacy)
+
+    torch.manual_seed(1)
+    model = CLIP(64, VISION_CFG, text_cfg, **model_kwargs)
+    model.load_state_dict(legacy)
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, expected[k]), k
+
+    # nested under a prefix, as when resuming through DDP's 'module.'
+    torch.manual_seed(1)
+    wrapped = torch.nn.ModuleDict(dict(module=CLIP(64, VISION_CFG, text_cfg, **model_kwargs)))
+    wrapped.load_state_dict({'module.' + k: v for k, v in legacy.items()})
+    for k, v in wrapped.module.state_dict().items():
+        assert torch.equal(v, expected[k]), k
@@ -0,0 +1,55 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from open_clip.model import CLIP
+
+VISION_CFG = dict(layers=2, width=64, head_width=32, patch_size=16, image_size=32)
+TEXT_CFG = dict(context_length=16, vocab_size=100, width=64, heads=4, layers=2,
+                attentional_pool=True, n_queries=4, attn_pooler_heads=4)
+SPARO_TYPES = [
+    f"{rep}:{norm}"
+    for rep in ("cont", "sqrtsem", "sem")
+    for norm in ("sqrtsoftmax", "softmax", "norm", "const")
+    if (rep, norm) != ("sem", "norm")
+]
+
+
+def _reference_project_for_sparo(x, sparo_type, L):
+    # the per-call formula the specialized projectors replaced, on (B, L, model_V) inputs
+    rep_type, norm_type = sparo_type.split(":")
+    if norm_type == "sqrtsoftmax":
+        weights = torch.sqrt(F.softmax(x[..., :1], dim=-2))
+        x = x[..., 1:]
+    elif norm_type == "softmax":
+        weights = F.normalize(F.softmax(x[..., :1], dim=-2), dim=-2)
+        x = x[..., 1:]
+    elif norm_type == "norm":
+        norm_in = x if rep_type == "cont" else torch.exp(x / 2.0)
+        full_norm = torch.norm(norm_in.view(*norm_in.shape[:-2], -1), dim=-1, keepdim=True).unsqueeze(-1)
+        weights = torch.norm(norm_in, dim=-1, keepdim=True) / full_norm
+    else:
+        weights = torch.sqrt(torch.ones_like(x[..., :1]) / L)
+    if rep_type == "cont":
+        out_rep = F.normalize(x, dim=-1)
+    elif rep_type == "sqrtsem":
+        out_rep = torch.sqrt(F.softmax(x, dim=-1))
+    else:
+        out_rep = F.normalize(F.softmax(x, dim=-1), dim=-1)
+    return out_rep * weights
+
+
+@pytest.mark.parametrize("sparo_type", SPARO_TYPES)
+def test_sparo_projector_matches_reference(sparo_type):
+    torch.manual_seed(0)
+    model = CLIP(64, VISION_CFG, TEXT_CFG, use_sparo=True, L=4, V=8, sparo_heads=2, sparo_type=sparo_type)
+    x = torch.randn(3, model.L, model.model_V)
+    with torch.no_grad():
+        actual = model._project_for_sparo(x)
+    expected = _reference_project_for_sparo(x, sparo_type, model.L)
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=1e-6)
+
+
+def test_sparo_projector_rejects_unknown_type():
+    with pytest.raises(NotImplementedError):
+        CLIP(64, VISION_CFG, TEXT_CFG, use_sparo=True, L=4, V=8, sparo_heads=2, sparo_type="sem:norm")